@@ -3,11 +3,104 @@ __date__ = '10/1/2021'
 __all__ = ['Standardizer',
            ]
 
-from typing import Any, Dict, List, Literal, Optional, Tuple, Union
-
+import os
+import tempfile
+from collections import OrderedDict
+from functools import lru_cache
+from importlib.util import find_spec
+from hashlib import blake2b
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Literal, Optional, Tuple, Union
+
+import joblib
 import numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from scipy.sparse import csr_matrix
 from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
+from sklearn.utils import gen_even_slices
+from sklearn.utils.extmath import safe_sparse_dot
+from threadpoolctl import threadpool_limits
+
+# Importing numba is slow and the compiled kernel is only used with several jobs, so it is only looked up here
+_HAS_NUMBA = find_spec('numba') is not None
+
+# Number of raw value and standard pairs above which the 'auto' backend moves the similarities to the GPU
+_GPU_MIN_PAIRS = 10 ** 7
+
+
+@lru_cache(maxsize=None)
+def _cuda_available() -> bool:
+    """
+    Checks if CuPy can reach a CUDA device; importing CuPy and starting the CUDA runtime is slow, so it is only done
+    once a GPU is needed
+    :return: True if the GPU can be used
+    """
+    try:
+        import cupy
+    except ImportError:
+        return False
+
+    try:
+        return cupy.cuda.runtime.getDeviceCount() > 0
+    except RuntimeError:
+        return False
+
+
+@lru_cache(maxsize=None)
+def _sparse_dot_kernel() -> Callable:
+    """
+    Imports numba and compiles the parallel similarity kernel the first time it is needed
+    :return: the compiled kernel
+    """
+    import numba
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _sparse_dot(indptr, indices, data, t_indptr, t_indices, t_data, n_cols):
+        """
+        Dense product of a CSR matrix with another matrix given as the CSR arrays of its transpose
+        :return: array of shape (rows of the first matrix, n_cols)
+        """
+        out = np.zeros((indptr.shape[0] - 1, n_cols), dtype=np.float32)
+
+        # Each row only writes to its own row of the output, so rows can be computed in parallel
+        for i in numba.prange(indptr.shape[0] - 1):
+            for k in range(indptr[i], indptr[i + 1]):
+                # Add this n-gram's contribution to every standard that shares it
+                f = indices[k]
+                for m in range(t_indptr[f], t_indptr[f + 1]):
+                    out[i, t_indices[m]] += data[k] * t_data[m]
+
+        return out
+
+    return _sparse_dot
+
+
+class _MemoizedAnalyzer:
+    """
+    Wraps an analyzer so the n-grams of each string are only generated once. An `lru_cache` around a lambda cannot be
+    pickled, so the cache is dropped when pickling and rebuilt empty when unpickling.
+    """
+
+    def __init__(self, analyze: Callable, maxsize: int) -> None:
+        self._analyze = analyze
+        self._maxsize = maxsize
+        self._memoized = lru_cache(maxsize=maxsize)(self._ngrams)
+
+    def __call__(self, doc: str) -> Tuple:
+        return self._memoized(doc)
+
+    def __getstate__(self) -> Dict:
+        return {'analyze': self._analyze, 'maxsize': self._maxsize}
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__init__(state['analyze'], state['maxsize'])
+
+    def cache_clear(self) -> None:
+        self._memoized.cache_clear()
+
+    def _ngrams(self, doc: str) -> Tuple:
+        return tuple(self._analyze(doc))
 
 
 class Standardizer:
@@ -18,6 +111,16 @@ class Standardizer:
         :keyword threshold: Cosine similarity threshold that sets the cutoff limit for
                             determining if words are similar enough.
         :keyword analyzer: Analyzer to use to generate n-grams: One of {'word', 'char', 'char-wb'}, default 'char'
+        :keyword n_jobs: Number of threads used to calculate similarities; -1 uses all cores, default 1
+        :keyword cache_dir: Directory in which fitted standards are stored and reused by later instances;
+                            default None, i.e. the standards are always fitted
+        :keyword backend: Where similarities are calculated: One of {'cpu', 'gpu', 'auto'}, default 'cpu';
+                          'auto' uses the GPU for large inputs when CuPy and a CUDA device are available
+        :keyword result_cache_size: Number of recent inputs whose full results are kept, so repeating one of them
+                                    returns immediately; 0 turns the cache off, default 1
+        :keyword sims_cache_size: Number of recently seen raw values whose similarities are kept, so they are not
+                                  compared to the standards again in later calls; each one holds a row with a
+                                  similarity for every standard, default 0, i.e. the cache is off
         """
 
         if len(standards) == 0:
@@ -28,31 +131,53 @@ class Standardizer:
             raise ValueError("N-Gram range cannot contain zeroes.")
         if ng_len[0] > ng_len[1]:
             raise ValueError("Max N-Gram length cannot be larger than Min N-Gram length.")
+        if (backend := kwargs.get('backend', 'cpu')) not in ('cpu', 'gpu', 'auto'):
+            raise ValueError("Backend must be one of 'cpu', 'gpu' or 'auto'.")
+        if backend == 'gpu' and not _cuda_available():
+            raise ValueError("The 'gpu' backend requires CuPy and a CUDA device.")
 
         self._analyzer = kwargs.get('analyzer', 'char')
+        self._backend = backend
+        self._cache_dir = kwargs.get('cache_dir')
+        self._exact = {}
         self._input_as_vectors = {}
         self._last_results = None
         self._new_strings = None
         self._ng_len = ng_len
+        self._n_jobs = kwargs.get('n_jobs', 1)
         self._questionable = None
         self._raw = None
+        self._raw_to_row = {}
+        self._sims = None
         self._standards = standards
+        self._top_cols = None
+        self._top_sims = None
+        self._unique_raw = []
 
         # Cosine Similarity threshold for determining if a new string is accurate or not
         self._threshold = kwargs.get("threshold", 0.45)
 
-        self._vectorizer = CountVectorizer(analyzer=self._analyzer, ngram_range=self._ng_len)
+        # Similarities and most similar standard of recently seen raw values, and the full results of the most
+        # recent inputs; both are ordered from least to most recently used
+        self._sims_cache = OrderedDict()
+        self._result_cache = OrderedDict()
+        self._result_cache_size = kwargs.get('result_cache_size', 1)
+        self._sims_cache_size = kwargs.get('sims_cache_size', 0)
+
+        # Tokenizing is the most expensive part of vectorizing, so the n-grams of each string are memoized and
+        # strings seen in earlier calls to `standardize_it` are not analyzed again
+        analyze = CountVectorizer(analyzer=self._analyzer, ngram_range=self._ng_len).build_analyzer()
+        self._analyze = _MemoizedAnalyzer(analyze, maxsize=200_000)
+        self._vectorizer = CountVectorizer(analyzer=self._analyze)
 
         # Make vectors for target make names
-        self._standard_vectors = dict(
-            zip(self._standards, self._fit_cv())
-        )
+        self._fit_standards()
 
     @property
     def input_as_vectors(self) -> Dict:
         """
         Getter method for input values and their corresponding vectors as transformed by the vectorizer
-        :return: input as vectors
+        :return: input as sparse row vectors
         """
         if self._input_as_vectors == {}:
             raise ValueError("No input has been supplied yet.")
@@ -62,11 +187,18 @@ class Standardizer:
     @property
     def last_results(self) -> Dict:
         """
-        Getter method for
-        :return: self.__last_results
+        Getter method for the similarities of each raw value, ordered from most to least similar standard
+        :return: dict with each raw string as key and the dict of standards and their similarities as the value
         """
-        if not self._last_results:
-            raise ValueError
+        if self._last_results is None:
+            if self._sims is None:
+                raise ValueError
+
+            # Similarities are kept as a single array, so the ranked dicts are only built when they are asked for
+            orders = self._top_k_order(self._sims, self._sims.shape[1])
+            self._last_results = {val: self._as_ranked_dict(val, row, order)
+                                  for val, row, order in zip(self._raw_to_row, self._sims, orders)}
+
         return self._last_results
 
     @property
@@ -123,10 +255,18 @@ class Standardizer:
         :param stds: New standards
         :return:
         """
+        if self._sims is not None:
+            # The similarities of the last input line up with the old standards, so they are ranked while those are
+            # still known and later lookups use the ranked dicts
+            self._last_results = self.last_results
+            self._sims = self._top_cols = self._top_sims = None
+            self._exact, self._raw_to_row, self._unique_raw = {}, {}, []
+
         self._standards = stds
-        self._standard_vectors = dict(
-            zip(self._standards, self._fit_cv())
-        )
+        self._analyze.cache_clear()
+        self._sims_cache.clear()
+        self._result_cache.clear()
+        self._fit_standards()
 
     @property
     def threshold(self) -> int:
@@ -140,7 +280,7 @@ class Standardizer:
     def standard_vectors(self) -> Dict:
         """
         Getter method for standardized values as vectors
-        :return: standards as vectors
+        :return: standards as sparse row vectors
         """
         return self._standard_vectors
 
@@ -207,57 +347,218 @@ class Standardizer:
 
         self._raw = raw
         self._threshold = kwargs.get('threshold', self._threshold)
-        self._last_results = {}
+
+        # Standardizing the same input with the same threshold again returns the stored results
+        key = (tuple(raw), self._threshold)
+        if key in self._result_cache:
+            self._result_cache.move_to_end(key)
+            (input_as_vectors, self._sims, self._raw_to_row, self._unique_raw, self._exact,
+             self._top_cols, self._top_sims, new_strings, questionable) = self._result_cache[key]
+
+            # The public results are handed out as copies, so changing them does not change the cached ones
+            self._input_as_vectors = dict(input_as_vectors)
+            self._new_strings = list(new_strings)
+            self._questionable = dict(questionable)
+            self._last_results = None
+            return
+
+        # Duplicates share their vectors and similarities, so each unique raw value is only transformed once
+        unique_raw = list(dict.fromkeys(raw))
+        self._unique_raw = unique_raw
 
         # Make vectors for the input make names
-        self._input_as_vectors = dict(zip(self._raw, self._vectorizer.transform(raw).toarray()))
-
-        # Calculate the cosine similarities
-        for val in raw:
-            if val in self._last_results.keys():
-                # If sims are already known for a value, we can skip it and use previous sims for replacement
-                continue
-            elif val in self._standards:
-                self._last_results[val] = {val: 1.00}
-                continue
-            else:
-                """
-                The count vectorizer only makes one vector for each raw string, even if it appears more than once.
-                As such we need to access the vector in input_as_vectors using the raw name as the key,
-                and pass that vector as the argument. Otherwise each misspelling only gets transformed once.
-                """
-                sims = self._calc_cosine_sim(word=self._input_as_vectors[val])
-                self._last_results[val] = sims
+        X_raw = self._vectorizer.transform(unique_raw).astype(np.float32)
+        self._input_as_vectors = dict(zip(unique_raw, X_raw))
+
+        # One row of similarities for each unique raw value, with a column for each standard, and the column of the
+        # most similar standard in each row
+        if self._sims_cache_size > 0:
+            self._sims, self._top_cols = self._cached_sims(unique_raw, X_raw)
+        else:
+            self._sims = self._parallel_cosine_sim(normalize(X_raw, copy=False))
+            self._top_cols = self._sims.argmax(axis=1)
+
+        self._top_sims = self._sims[np.arange(len(unique_raw)), self._top_cols]
+        self._raw_to_row = {val: i for i, val in enumerate(unique_raw)}
+        self._last_results = None
+
+        # Raw values that already are a standard are matched to it exactly
+        self._exact = {val: self._standard_cols[val] for val in unique_raw if val in self._standard_cols}
+
+        for val, j in self._exact.items():
+            self._top_cols[self._raw_to_row[val]] = j
+            self._top_sims[self._raw_to_row[val]] = 1.00
 
         # Call function to create a list of the most similar standard strings
         self._most_similar()
 
-    def _calc_cosine_sim(self, word: np.ndarray) -> Dict:
+        if self._result_cache_size > 0:
+            # Only keep the results of the most recent inputs
+            while len(self._result_cache) >= self._result_cache_size:
+                self._result_cache.popitem(last=False)
+            self._result_cache[key] = (dict(self._input_as_vectors), self._sims, self._raw_to_row, self._unique_raw,
+                                       self._exact, self._top_cols, self._top_sims, tuple(self._new_strings),
+                                       dict(self._questionable))
+
+    def _as_ranked_dict(self, val: str, row: np.ndarray, order: np.ndarray) -> Dict:
         """
-            Calculates the cosine similarity of 'word' against all members of 'targets'
-            :param word: String as currently spelled - to be corrected
-            :return: dict of similarities, with standard string as key and the similarity to the raw string as the value
-            """
-        sims = []  # List of similarities to the word in question
+        Pairs the ranked standards of a raw value with their similarities
+        :param val: Raw string
+        :param row: Similarities of the raw string to every standard
+        :param order: Columns of the standards, from highest to lowest similarity
+        :return: dict of standards and their similarities, from highest to lowest
+        """
+        if val in self._exact:
+            return {val: 1.00}
+
+        # Similarities are gathered in the ranked order in one step, instead of being looked up one by one
+        return dict(zip([self._standards[j] for j in order], row[order].tolist()))
+
+    def _cached_sims(self, unique_raw: List, vectors: csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Calculates the similarities of the unique raw values that are not in the per-string cache, and adds them to it
+        :param unique_raw: Unique raw strings
+        :param vectors: Vectors of the unique raw strings as transformed by the vectorizer
+        :return: array of similarities with one row per raw string, and the column of the most similar standard of each
+        """
+        sims = np.empty((len(unique_raw), len(self._standards)), dtype=np.float32)
+        top_cols = np.empty(len(unique_raw), dtype=np.intp)
+
+        # Raw values seen in earlier calls reuse their similarities, so only new values are calculated
+        new_rows = []
+        for i, val in enumerate(unique_raw):
+            if val in self._sims_cache:
+                sims[i], top_cols[i] = self._sims_cache[val]
+                self._sims_cache.move_to_end(val)
+            else:
+                new_rows.append(i)
+
+        if new_rows:
+            new_sims = self._parallel_cosine_sim(normalize(vectors[new_rows], copy=False))
+
+            # The most similar standard is found while the new rows are at hand; the first one wins ties,
+            # as in the ranked results
+            new_cols = new_sims.argmax(axis=1)
+            sims[new_rows] = new_sims
+            top_cols[new_rows] = new_cols
+
+            # Rows are copied so cached values do not keep their whole batch alive, and only as many as fit are kept
+            for i, row, col in list(zip(new_rows, new_sims, new_cols))[-self._sims_cache_size:]:
+                self._sims_cache[unique_raw[i]] = (row.copy(), col)
+            while len(self._sims_cache) > self._sims_cache_size:
+                self._sims_cache.popitem(last=False)
+
+        return sims, top_cols
+
+    def _calc_cosine_sim(self, words: csr_matrix) -> np.ndarray:
+        """
+        Calculates the cosine similarity of each row of 'words' against all of the standards
+        :param words: L2-normalized vectors of strings as currently spelled - to be corrected
+        :return: array of similarities, with one row per word and one column per standard
+        """
+        # Both sides are already L2-normalized, so the cosine similarity reduces to a plain dot product
+        if self._use_gpu(words.shape[0]):
+            import cupy
+            import cupyx.scipy.sparse
+
+            if self._std_mat_gpu is None:
+                # Standards stay on the GPU once uploaded, so later calls only transfer the raw vectors and similarities
+                self._std_mat_gpu = cupyx.scipy.sparse.csr_matrix(self._std_mat_t)
+
+            return cupy.asnumpy((cupyx.scipy.sparse.csr_matrix(words) @ self._std_mat_gpu).toarray())
+
+        # Calling the product directly skips the input validation of `linear_kernel`, which dominates small batches
+        return safe_sparse_dot(words, self._std_mat_t, dense_output=True)
+
+    def _fit_cv(self) -> csr_matrix:
+        """
+        Fit CountVectorizer to list of standards, or load the fit from the cache directory if it is stored there
+        :return: Vectorized standards as a sparse float32 matrix
+        """
+        if self._cache_dir is None:
+            return self._vectorizer.fit_transform(self._standards).astype(np.float32)
+
+        # The fit only depends on the analyzer settings and the standards, in order
+        key = blake2b(repr((self._analyzer, self._ng_len, list(self._standards))).encode(), digest_size=16)
+        path = Path(self._cache_dir) / f"{key.hexdigest()}.joblib"
+
+        if path.exists():
+            try:
+                self._vectorizer.vocabulary_, std_vectors = joblib.load(path)
+                return std_vectors
+            except Exception:
+                # A file that cannot be loaded, e.g. one left truncated by an older version, is fitted and written again
+                pass
+
+        std_vectors = self._vectorizer.fit_transform(self._standards).astype(np.float32)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # The fit is written to a temporary file and then moved into place, so other instances never load a partly
+        # written file
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                joblib.dump((self._vectorizer.vocabulary_, std_vectors), f)
+            os.replace(tmp, path)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
 
-        for tgt in self._standard_vectors.values():
-            # Use index to access the actual numeric value instead of storing it as `np.ndarray(['similarity'])`
-            sims.append(cosine_similarity([word], [tgt])[0][0])
+        return std_vectors
 
-        # Make dict of target makes, and the cosine similarity with each
-        target_sims = dict(zip(self._standards, sims))
+    def _fit_standards(self) -> None:
+        """
+        Fit the vectorizer to the standards and store their vectors
+        :return: None
+        """
+        std_vectors = self._fit_cv()
+        self._standard_vectors = dict(zip(self._standards, std_vectors))
 
-        # Reorder dict to go from highest to lowest similarity
-        target_sims = {k: v for k, v in sorted(target_sims.items(), key=lambda x: x[1], reverse=True)}
+        # Column of each standard for constant-time lookups; repeated standards map to their first column,
+        # which is also the one `argmax` picks since their similarities are identical
+        self._standard_cols = {}
+        for j, std in enumerate(self._standards):
+            self._standard_cols.setdefault(std, j)
 
-        return target_sims
+        # Standards as one row-normalized matrix, so similarities can be computed in a single product
+        self._std_mat = normalize(std_vectors, copy=False)
 
-    def _fit_cv(self) -> np.ndarray:
+        # Products with the raw vectors, and the compiled kernel, walk the standards by n-gram
+        self._std_mat_t = self._std_mat.T.tocsr()
+
+        # Sparse copy of the transposed standards on the GPU, uploaded the first time the GPU is used
+        self._std_mat_gpu = None
+
+    def _parallel_cosine_sim(self, words: csr_matrix) -> np.ndarray:
         """
-        Fit CountVectorizer to list of standards
-        :return: Vectorized standards as an array
+        Splits 'words' into one chunk per job and calculates their cosine similarities in separate threads
+        :param words: L2-normalized vectors of strings as currently spelled - to be corrected
+        :return: array of similarities, with one row per word and one column per standard
         """
-        return self._vectorizer.fit_transform(self._standards).toarray()
+        n_jobs = effective_n_jobs(self._n_jobs)
+
+        if n_jobs == 1 or self._use_gpu(words.shape[0]) or words.shape[0] < n_jobs:
+            return self._calc_cosine_sim(words)
+
+        if _HAS_NUMBA:
+            import numba
+
+            # The compiled kernel already runs in parallel, so it gets the jobs as its threads instead of joblib
+            sparse_dot = _sparse_dot_kernel()
+            n_threads = numba.get_num_threads()
+            numba.set_num_threads(min(n_jobs, numba.config.NUMBA_NUM_THREADS))
+            try:
+                t = self._std_mat_t
+                return sparse_dot(words.indptr, words.indices, words.data, t.indptr, t.indices, t.data, t.shape[1])
+            finally:
+                numba.set_num_threads(n_threads)
+
+        # Limit BLAS to a single thread per job so the jobs do not oversubscribe the cores
+        with threadpool_limits(limits=1):
+            chunks = Parallel(n_jobs=n_jobs, prefer='threads')(
+                delayed(self._calc_cosine_sim)(words[s]) for s in gen_even_slices(words.shape[0], n_jobs)
+            )
+
+        return np.vstack(chunks)
 
     def _get_by_int(self, get_from: str, i: int, n: Optional[int]):
         """
@@ -280,16 +581,18 @@ class Standardizer:
         :param n: Number of elements to return, defaults to `all`
         :return: string or List of all new strings corresponding to that input value
         """
-        if get_from == 'raw':  # If trying to get new strings from raw inputs, get value from __last_results
-            res = list(self._last_results[s].keys())
+        if get_from == 'raw':  # If trying to get new strings from raw inputs, rank the standards for that value
+            res = list(self._ranked(s, n) if self._sims is not None else self._last_results[s])
+        elif self._sims is None:  # Results ranked before the standards changed are only kept as dicts
+            res = [raw for raw, sims in self._last_results.items() if next(iter(sims)) == s]
         else:  # by must necessarily be `new` here since it was type-checked against a Literal
             """
-            Iterate through results
-            Get the values (i.e. the dict of sims) for each key (i.e. raw value) in __last_results
-            If the first key (i.e. the most similar) matches argument `s`, return that top-level key (i.e. raw string)
-            This has the effect of returning all of the raw strings that were standardized to the input `new string` 
+            Find the column of the standard `s`, then the rows whose most similar standard is that column
+            Return the raw strings of those rows, in the order they were first seen
+            This has the effect of returning all of the raw strings that were standardized to the input `new string`
             """
-            res = [raw for raw, sims in self._last_results.items() if list(sims.keys())[0] == s]
+            rows = np.flatnonzero(self._top_cols == self._standard_cols[s]) if s in self._standard_cols else []
+            res = [self._unique_raw[i] for i in rows]
 
         return res[0] if n == 1 else res[:n]  # Return top `n` strings
 
@@ -298,18 +601,70 @@ class Standardizer:
         Returns the first standardized value (i.e. most similar) for each raw input string
         :return: List of standardized strings most aligned with raw input
         """
-        self._new_strings = []
-        self._questionable = {}
+        # Map each raw value to its row, so the best match of every raw value is picked in a single pass
+        rows = np.fromiter((self._raw_to_row[val] for val in self._raw), dtype=np.intp, count=len(self._raw))
+        best_cols = self._top_cols[rows]
+        best_sims = self._top_sims[rows]
+
+        self._new_strings = [self._standards[j] for j in best_cols]
 
-        for val in self._raw:
-            # For each raw value, get the most similar string and its cosine similarity score
-            top_result = list(self._last_results[val].items())[0]
+        # Most similar scores at or below the user-defined threshold are flagged as `questionable`
+        self._questionable = {self._raw[i]: (self._new_strings[i], float(best_sims[i]))
+                              for i in np.flatnonzero(best_sims <= self._threshold)}
 
-            if top_result[1] <= self._threshold:
-                # If the most similar score is below the user-defined threshold, append it to the `questionable` dict
-                self._questionable[val] = top_result
+    def _ranked(self, val: str, n: Optional[int]) -> Dict:
+        """
+        Ranks the standards most similar to a raw value
+        :param val: Raw string
+        :param n: Number of standards to rank, defaults to all
+        :return: dict of the `n` most similar standards and their similarities, from highest to lowest
+        """
+        row = self._sims[self._raw_to_row[val]]
+
+        # Any other `n` is left to the caller's slicing; repeated standards share one entry in the ranked dict, so
+        # they could leave fewer than `n` entries and the whole row is ranked for them too
+        if isinstance(n, int) and 0 < n < len(row) and len(self._standard_cols) == len(self._standards):
+            k = n
+        else:
+            k = len(row)
+        order = self._top_k_order(row[np.newaxis], k)[0]
+
+        return self._as_ranked_dict(val, row, order)
+
+    @staticmethod
+    def _top_k_order(sims: np.ndarray, k: int) -> np.ndarray:
+        """
+        Finds the columns of the `k` highest similarities in each row without sorting the whole row
+        :param sims: array of similarities, with one row per word and one column per standard
+        :param k: Number of columns to keep for each row
+        :return: array of column indices from highest to lowest similarity; ties keep the order of the standards
+        """
+        if k < sims.shape[1]:
+            # Keep everything above the k-th highest similarity, then fill up with ties in the order of the standards
+            kth = -np.partition(-sims, k - 1, axis=1)[:, k - 1:k]
+            above = sims > kth
+            ties = sims == kth
+            keep = above | (ties & (np.cumsum(ties, axis=1) <= k - above.sum(axis=1, keepdims=True)))
+            cols = np.nonzero(keep)[1].reshape(-1, k)
+        else:
+            cols = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+
+        order = np.argsort(-np.take_along_axis(sims, cols, axis=1), axis=1, kind='stable')
+
+        return np.take_along_axis(cols, order, axis=1)
+
+    def _use_gpu(self, n_rows: int) -> bool:
+        """
+        Decide if the similarities of `n_rows` raw values are calculated on the GPU
+        :param n_rows: Number of raw values
+        :return: True if the GPU should be used
+        """
+        if self._backend == 'cpu':
+            return False
+        if self._backend == 'auto' and n_rows * self._std_mat.shape[0] <= _GPU_MIN_PAIRS:
+            return False
 
-            self._new_strings.append(top_result[0])  # Append most similar string to new_strings
+        return _cuda_available()
 
     def __getitem__(self, item):
         if isinstance(item, str):
@@ -0,0 +1,222 @@
+import pickle
+import sys
+from types import ModuleType, SimpleNamespace
+
+import joblib
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+
+from standardize_it import Standardizer
+from standardize_it.standardize_it import _cuda_available
+
+STANDARDS = ["CHEVROLET", "NISSAN", "HYUNDAI", "TOYOTA", "CHRYSLER", "MERCEDES-BENZ", "SUBARU", "VOLKSWAGEN",
+             "FORD", "MAZDA", "CADILLAC"]
+RAW = ["CHEVR", "NISSA", "HYUND", "TOYOT", "CHRYS", "MERCE", "SUBAR", "VOLKS", "FORD", "FORD TRUCK", "CHERVOLET",
+       "CHEVY", "CHEVY TRUCKS", "NISS", "MAZD", "CADI", "NISSA", "FORD", "QQQ"]
+
+
+@pytest.fixture
+def standardizer():
+    s = Standardizer(STANDARDS)
+    s.standardize_it(RAW)
+    return s
+
+
+def test_pickle_round_trip(standardizer):
+    restored = pickle.loads(pickle.dumps(standardizer))
+    restored.standardize_it(RAW)
+
+    assert restored.new_strings == standardizer.new_strings
+    assert restored.last_results == standardizer.last_results
+
+
+def test_top_k_order_fills_ties_in_order_of_standards():
+    sims = np.array([[0.5, 0.9, 0.5, 0.5, 0.9]], dtype=np.float32)
+
+    assert Standardizer._top_k_order(sims, 3).tolist() == [[1, 4, 0]]
+
+
+@pytest.mark.parametrize('k', [1, 2, 5, 11, 12])
+def test_top_k_order_matches_stable_sort(k):
+    # Few distinct values, so most rows have ties at the cut-off
+    sims = np.random.default_rng(0).integers(0, 4, size=(50, 12)).astype(np.float32) / 4
+    expected = np.argsort(-sims, axis=1, kind='stable')[:, :k]
+
+    np.testing.assert_array_equal(Standardizer._top_k_order(sims, k), expected)
+
+
+@pytest.mark.parametrize('n', [2, 5, 10])
+def test_get_related_matches_last_results(standardizer, n):
+    for val in set(RAW):
+        assert standardizer.get_related('raw', val, n=n) == list(standardizer.last_results[val])[:n]
+
+
+def test_last_results_rank_every_standard(standardizer):
+    assert len(standardizer.last_results['CHEVY']) == len(STANDARDS)
+
+
+def test_get_related_with_repeated_standards():
+    s = Standardizer(['FORD', 'FORD', 'FORK', 'CORD', 'NISSAN'])
+    s.standardize_it(['FORX'])
+
+    assert s.get_related('raw', 'FORX', n=2) == ['FORD', 'FORK']
+
+
+def test_sims_cache_is_off_by_default(standardizer):
+    assert len(standardizer._sims_cache) == 0
+
+
+def test_sims_cache_is_bounded():
+    s = Standardizer(STANDARDS, sims_cache_size=3)
+    s.standardize_it(RAW)
+
+    assert len(s._sims_cache) == 3
+    assert all(row.base is None for row, _ in s._sims_cache.values())
+
+    s.standardize_it(RAW[::-1])
+    fresh = Standardizer(STANDARDS)
+    fresh.standardize_it(RAW[::-1])
+    assert s.new_strings == fresh.new_strings
+
+
+def test_result_cache_can_be_turned_off():
+    s = Standardizer(STANDARDS, result_cache_size=0)
+    s.standardize_it(RAW)
+    s.standardize_it(RAW)
+
+    assert len(s._result_cache) == 0
+
+
+def test_changing_results_does_not_change_cached_results(standardizer):
+    expected = list(standardizer.new_strings)
+    standardizer.new_strings[0] = 'MUTATED'
+    standardizer.questionable.clear()
+    standardizer.standardize_it(list(RAW))
+
+    assert standardizer.new_strings == expected
+    assert 'QQQ' in standardizer.questionable
+
+    standardizer.new_strings[0] = 'MUTATED'
+    standardizer.standardize_it(list(RAW))
+    assert standardizer.new_strings == expected
+
+
+@pytest.mark.parametrize('has_numba', [True, False])
+def test_n_jobs_matches_single_job(standardizer, monkeypatch, has_numba):
+    # Without numba the rows are split into chunks across joblib threads instead
+    monkeypatch.setattr('standardize_it.standardize_it._HAS_NUMBA', has_numba)
+    s = Standardizer(STANDARDS, n_jobs=2)
+    s.standardize_it(RAW)
+
+    assert s.new_strings == standardizer.new_strings
+    # The jobs sum each similarity in a different order, so only the last bits of the scores may differ
+    assert s.last_results.keys() == standardizer.last_results.keys()
+    for raw, sims in s.last_results.items():
+        assert list(sims) == list(standardizer.last_results[raw])
+        assert sims == pytest.approx(standardizer.last_results[raw])
+
+
+def test_questionable_scores_are_floats(standardizer):
+    assert standardizer.questionable
+    assert all(type(sim) is float for _, sim in standardizer.questionable.values())
+
+
+@pytest.fixture
+def fake_cupy(monkeypatch):
+    """CuPy stand-in backed by scipy, which records every transfer back from the 'GPU'"""
+    cupy = ModuleType('cupy')
+    cupy.transfers = []
+    cupy.cuda = SimpleNamespace(runtime=SimpleNamespace(getDeviceCount=lambda: 1))
+
+    def asnumpy(a):
+        cupy.transfers.append(a.shape)
+        return np.asarray(a)
+
+    cupy.asnumpy = asnumpy
+
+    cupyx, cupyx_scipy, cupyx_sparse = ModuleType('cupyx'), ModuleType('cupyx.scipy'), ModuleType('cupyx.scipy.sparse')
+    cupyx.scipy, cupyx_scipy.sparse = cupyx_scipy, cupyx_sparse
+    cupyx_sparse.csr_matrix = csr_matrix
+
+    for module in (cupy, cupyx, cupyx_scipy, cupyx_sparse):
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+    _cuda_available.cache_clear()
+    yield cupy
+    _cuda_available.cache_clear()
+
+
+def test_unknown_backend_raises():
+    with pytest.raises(ValueError):
+        Standardizer(STANDARDS, backend='bogus')
+
+
+def test_gpu_backend_without_cupy_raises(monkeypatch):
+    # A None entry makes importing CuPy fail even where it is installed
+    monkeypatch.setitem(sys.modules, 'cupy', None)
+    _cuda_available.cache_clear()
+    try:
+        with pytest.raises(ValueError):
+            Standardizer(STANDARDS, backend='gpu')
+    finally:
+        _cuda_available.cache_clear()
+
+
+@pytest.mark.parametrize('extra_pairs, uses_gpu', [(0, False), (-1, True)])
+def test_auto_backend_uses_gpu_above_min_pairs(standardizer, fake_cupy, monkeypatch, extra_pairs, uses_gpu):
+    pairs = len(set(RAW)) * len(STANDARDS)
+    monkeypatch.setattr('standardize_it.standardize_it._GPU_MIN_PAIRS', pairs + extra_pairs)
+    s = Standardizer(STANDARDS, backend='auto')
+    s.standardize_it(RAW)
+
+    assert fake_cupy.transfers == ([(len(set(RAW)), len(STANDARDS))] if uses_gpu else [])
+    assert s.new_strings == standardizer.new_strings
+    assert s.last_results == standardizer.last_results
+
+
+@pytest.mark.parametrize('n', [-1, 0, None])
+def test_get_related_without_positive_n_slices_full_ranking(standardizer, n):
+    assert standardizer.get_related('raw', 'CHEVY', n=n) == list(standardizer.last_results['CHEVY'])[:n]
+
+
+def test_cache_dir_reuses_fitted_standards(tmp_path, standardizer):
+    Standardizer(STANDARDS, cache_dir=tmp_path)
+    [path] = tmp_path.iterdir()
+
+    s = Standardizer(STANDARDS, cache_dir=tmp_path)
+    s.standardize_it(RAW)
+    assert s.new_strings == standardizer.new_strings
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_cache_dir_refits_unreadable_file(tmp_path, standardizer):
+    Standardizer(STANDARDS, cache_dir=tmp_path)
+    [path] = tmp_path.iterdir()
+    path.write_bytes(path.read_bytes()[:10])
+
+    s = Standardizer(STANDARDS, cache_dir=tmp_path)
+    s.standardize_it(RAW)
+    assert s.new_strings == standardizer.new_strings
+    assert list(tmp_path.iterdir()) == [path]
+    assert joblib.load(path)[0] == s._vectorizer.vocabulary_
+
+
+@pytest.mark.parametrize('std', ['FORD', 'NISSAN', 'QQQ'])
+def test_get_related_new_returns_raw_values_standardized_to_it(standardizer, std):
+    expected = list(dict.fromkeys(raw for raw, new in zip(RAW, standardizer.new_strings) if new == std))
+
+    assert standardizer.get_related('new', std, n=None) == expected
+
+
+def test_results_keep_their_standards_after_standards_change(standardizer):
+    expected = {'last_results': standardizer.last_results, 'new_strings': standardizer.new_strings,
+                'raw': standardizer.get_related('raw', 'NISSA', n=3), 'new': standardizer.get_related('new', 'FORD')}
+    standardizer.standards = ['MAZDA', 'HONDA']
+
+    assert standardizer.last_results == expected['last_results']
+    assert standardizer.new_strings == expected['new_strings']
+    assert standardizer.get_related('raw', 'NISSA', n=3) == expected['raw']
+    assert standardizer.get_related('new', 'FORD') == expected['new']
+
+    standardizer.standardize_it(RAW)
+    assert list(standardizer.last_results['CHEVY']) == ['MAZDA', 'HONDA']